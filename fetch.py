@@ -1,18 +1,24 @@
 #!/usr/bin/env python3
 """
 Fetch weather data for a list of localities from Weather Union API,
-rotating through multiple API keys and saving results as CSV.
+rotating through multiple API keys and saving results as CSV or Parquet.
 Supports YAML config.
 """
 
 import os
 import csv
+import math
 import time
+import asyncio
 import logging
+import functools
+import queue
+import itertools
+import collections
 from datetime import datetime
 
-import pandas as pd
-import requests
+import httpx
+import orjson
 import yaml
 
 # ─── Configuration ─────────────────────────────────────────────────────────────
@@ -28,6 +34,24 @@ OUTPUT_BASE_DIR   = cfg['paths']['output_base_dir']
 BASE_URL          = cfg['api']['base_url']
 MAX_CALLS_PER_KEY = cfg['api'].get('max_calls_per_key', 1000)
 
+OUTPUT_FORMAT     = cfg.get('output', {}).get('format', 'csv')
+BATCH_ROWS        = cfg.get('output', {}).get('batch_rows', 1024)
+QUEUE_SIZE        = 4096
+
+MAX_CONCURRENCY   = 32
+REQUEST_TIMEOUT   = 10.0
+
+MAX_RETRIES       = 3
+BACKOFF_FACTOR    = 0.3
+RETRY_STATUSES    = {502, 503, 504}
+MAX_RETRY_AFTER   = 5
+
+OUTPUT_FIELDS = (
+    'Station ID', 'Locality Name', 'Latitude', 'Longitude',
+    'Observation Datetime', 'Temperature', 'Humidity', 'Wind Speed',
+    'Wind Direction', 'Rain Intensity', 'Total Rainfall',
+)
+
 # ─── Logging Setup ─────────────────────────────────────────────────────────────
 logging.basicConfig(
     level=logging.INFO,
@@ -37,94 +61,315 @@ logging.basicConfig(
 
 def load_csv(path):
     try:
-        return pd.read_csv(path)
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            return list(csv.DictReader(f))
     except FileNotFoundError:
         logging.error(f"CSV file not found: {path}")
         raise
 
-def get_weather_data(station_id, api_key):
-    headers = {
-        'x-zomato-api-key': api_key,
-        'Content-Type': 'application/json'
-    }
-    params = {'locality_id': station_id}
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+@functools.lru_cache(maxsize=None)
+def load_locations(path):
+    # Locality metadata does not change while the process runs, so the
+    # station ID -> (name, lat, lon) map is built once and reused by every fetch.
+    return {row['localityId']: (row.get('localityName', ''),
+                                to_float(row.get('latitude')),
+                                to_float(row.get('longitude')))
+            for row in load_csv(path)}
 
+def load_api_keys(path):
+    return [row['API_KEY'] for row in load_csv(path)]
+
+def parse_retry_after(value):
     try:
-        resp = requests.get(BASE_URL, params=params, headers=headers, timeout=10)
-        if resp.status_code == 200:
-            return resp.json()
-        if resp.status_code == 429:
-            logging.warning("Quota limit reached for key %s", api_key)
-            return 'QUOTA_LIMIT_REACHED'
-        logging.error("HTTP %s fetching station %s", resp.status_code, station_id)
-    except requests.RequestException as e:
-        logging.error("Request error for station %s: %s", station_id, e)
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+async def get_weather_data(client, station_id, api_key, headers):
+    params = {'locality_id': station_id}
+    delay, throttled = 0, False
+
+    for attempt in range(MAX_RETRIES + 1):
+        if delay:
+            await asyncio.sleep(delay)
+        delay = BACKOFF_FACTOR * (2 ** attempt)
+        try:
+            resp = await client.get(BASE_URL, params=params, headers=headers)
+            if resp.status_code == 200:
+                try:
+                    return orjson.loads(resp.content)
+                except orjson.JSONDecodeError as e:
+                    logging.error("Invalid JSON for station %s: %s", station_id, e)
+                    return None
+            if resp.status_code == 429:
+                # A short Retry-After is a burst limit, not an exhausted
+                # quota: wait it out once on the same key before rotating.
+                retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+                if (not throttled and attempt < MAX_RETRIES
+                        and retry_after is not None
+                        and retry_after <= MAX_RETRY_AFTER):
+                    throttled, delay = True, retry_after
+                    continue
+                logging.warning("Quota limit reached for key %s", api_key)
+                return 'QUOTA_LIMIT_REACHED'
+            if resp.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                continue
+            logging.error("HTTP %s fetching station %s", resp.status_code, station_id)
+            return None
+        except httpx.HTTPError as e:
+            if attempt < MAX_RETRIES:
+                continue
+            logging.error("Request error for station %s: %s", station_id, e)
     return None
 
-def fetch_and_save():
-    locations = load_csv(LOCATIONS_CSV)
-    api_keys  = load_csv(API_KEYS_CSV)['API_KEY'].tolist()
+def build_record(station_id, skeleton, w, obs_ts):
+    # Values must follow the order of OUTPUT_FIELDS.
+    name, lat, lon = skeleton
+    return (
+        station_id,
+        name,
+        lat,
+        lon,
+        obs_ts,
+        w.get('temperature'),
+        w.get('humidity'),
+        w.get('wind_speed'),
+        w.get('wind_direction'),
+        w.get('rain_intensity'),
+        w.get('rain_accumulation'),
+    )
 
-    results = []
-    key_idx, call_count = 0, 0
+class KeyPool:
+    # Ring of usable keys. Each call hands out the key at the front and
+    # rotates, so concurrent requests spread across all keys; a key leaves the
+    # ring once it has served MAX_CALLS_PER_KEY calls or hits its quota.
+    def __init__(self, api_keys, max_calls=MAX_CALLS_PER_KEY):
+        self.ring = collections.deque(api_keys)
+        self.usage = {k: itertools.count(1) for k in api_keys}
+        self.max_calls = max_calls
 
-    start = time.time()
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M")
+    def get_key(self):
+        if not self.ring:
+            return None
+        key = self.ring[0]
+        self.ring.rotate(-1)
+        if next(self.usage[key]) >= self.max_calls:
+            self.retire(key)
+        return key
 
-    for _, row in locations.iterrows():
-        station_id = row['localityId']
+    def retire(self, key):
+        if key in self.ring:
+            self.ring.remove(key)
 
-        while key_idx < len(api_keys):
-            key = api_keys[key_idx]
-            data = get_weather_data(station_id, key)
+async def fetch_all(skeletons, api_keys, obs_ts, emit):
+    # MAX_CONCURRENCY workers share one iterator of station IDs. A worker only
+    # takes its next station after emit() has accepted the previous record, so
+    # a slow consumer stops new requests instead of letting records pile up.
+    pool = KeyPool(api_keys)
+    headers_by_key = {k: {'x-zomato-api-key': k} for k in api_keys}
+    station_ids = iter(skeletons)
+    skipped = 0
 
-            if data == 'QUOTA_LIMIT_REACHED':
-                key_idx += 1
-                call_count = 0
-                continue
+    async def fetch_one(client, station_id):
+        nonlocal skipped
+        while True:
+            key = pool.get_key()
+            if key is None:
+                skipped += 1
+                return None
+            data = await get_weather_data(client, station_id, key,
+                                        headers_by_key[key])
+            if data != 'QUOTA_LIMIT_REACHED':
+                break
+            pool.retire(key)
 
-            if data and 'locality_weather_data' in data:
-                w = data['locality_weather_data']
-                record = {
-                    'Station ID': station_id,
-                    'Locality Name': row.get('localityName', ''),
-                    'Latitude': row.get('latitude', ''),
-                    'Longitude': row.get('longitude', ''),
-                    'Observation Datetime': datetime.now().isoformat(),
-                    'Temperature': w.get('temperature'),
-                    'Humidity': w.get('humidity'),
-                    'Wind Speed': w.get('wind_speed'),
-                    'Wind Direction': w.get('wind_direction'),
-                    'Rain Intensity': w.get('rain_intensity'),
-                    'Total Rainfall': w.get('rain_accumulation'),
-                }
-                results.append(record)
-                call_count += 1
-            else:
-                logging.info("No data for station %s", station_id)
-
-            if call_count >= MAX_CALLS_PER_KEY:
-                key_idx += 1
-                call_count = 0
-            break
-
-        if key_idx >= len(api_keys):
-            logging.error("All API keys exhausted; stopping early.")
-            break
-
-    date_dir = datetime.now().strftime("%Y%m%d")
+        if data and 'locality_weather_data' in data:
+            return build_record(station_id, skeletons[station_id],
+                                data['locality_weather_data'], obs_ts)
+        logging.info("No data for station %s", station_id)
+        return None
+
+    async def worker(client):
+        for station_id in station_ids:
+            record = await fetch_one(client, station_id)
+            if record is not None:
+                await emit(record)
+
+    limits = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+    async with httpx.AsyncClient(http2=True, limits=limits,
+                                 timeout=REQUEST_TIMEOUT) as client:
+        workers = [asyncio.create_task(worker(client))
+                   for _ in range(MAX_CONCURRENCY)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    if skipped:
+        logging.error("All API keys exhausted; skipped %d stations.", skipped)
+
+def write_csv(records, out_file):
+    # Rows are written and synced in batches, so a crash loses at most the
+    # batch in progress.
+    count, batch = 0, []
+    with open(out_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(OUTPUT_FIELDS)
+
+        def write_batch():
+            writer.writerows(batch)
+            f.flush()
+            os.fsync(f.fileno())
+            batch.clear()
+
+        for record in records:
+            batch.append(record)
+            count += 1
+            if len(batch) >= BATCH_ROWS:
+                write_batch()
+        if batch:
+            write_batch()
+    return count
+
+def parquet_schema(pa):
+    # Columns are laid out in OUTPUT_FIELDS order. Integer weather columns are
+    # stored as value * scale, rounded half up; readers divide by the 'scale'
+    # metadata.
+    types = {
+        'Station ID': pa.string(),
+        'Locality Name': pa.string(),
+        'Latitude': pa.float64(),
+        'Longitude': pa.float64(),
+        'Observation Datetime': pa.string(),
+        'Temperature': pa.float32(),
+        'Humidity': pa.uint8(),
+        'Wind Speed': pa.float32(),
+        'Wind Direction': pa.float32(),
+        'Rain Intensity': pa.uint16(),
+        'Total Rainfall': pa.uint16(),
+    }
+    scaled = {'Rain Intensity': {'scale': '10'}, 'Total Rainfall': {'scale': '10'}}
+    return pa.schema([pa.field(name, types[name], metadata=scaled.get(name))
+                      for name in OUTPUT_FIELDS])
+
+def downcast(values, field):
+    scale = int((field.metadata or {}).get(b'scale', 1))
+    limit = (1 << field.type.bit_width) - 1
+    out = []
+    for v in values:
+        try:
+            n = math.floor(float(v) * scale + 0.5)
+        except (TypeError, ValueError, OverflowError):
+            out.append(None)
+            continue
+        if not 0 <= n <= limit:
+            logging.warning("%s value %s out of range; storing null", field.name, v)
+            n = None
+        out.append(n)
+    return out
+
+def write_parquet(records, out_file):
+    # pyarrow is only needed for this output format.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema(pa)
+    count, batch = 0, []
+
+    def write_batch(writer):
+        arrays = []
+        for col, field in zip(zip(*batch), schema):
+            if pa.types.is_unsigned_integer(field.type):
+                col = downcast(col, field)
+            arrays.append(pa.array(col, type=field.type, from_pandas=True))
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        batch.clear()
+
+    with pq.ParquetWriter(out_file, schema, compression='zstd') as writer:
+        for record in records:
+            batch.append(record)
+            count += 1
+            if len(batch) >= BATCH_ROWS:
+                write_batch(writer)
+        if batch:
+            write_batch(writer)
+    return count
+
+WRITERS = {
+    'csv': (write_csv, 'csv'),
+    'parquet': (write_parquet, 'parquet'),
+}
+
+_DONE = object()
+
+def drain(q):
+    while (record := q.get()) is not _DONE:
+        yield record
+
+async def enqueue(q, record, writer):
+    # Surface a writer failure before queueing anything else, so no more API
+    # calls are spent on records that can no longer be saved. When the queue
+    # is full, wait for room in a worker thread; the timeout bounds how long a
+    # writer that dies meanwhile can go unnoticed.
+    loop = asyncio.get_running_loop()
+    while True:
+        if writer.done():
+            writer.result()
+        try:
+            q.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        try:
+            await loop.run_in_executor(None, q.put, record, True, 1.0)
+            return
+        except queue.Full:
+            pass
+
+async def fetch_to_file(skeletons, api_keys, obs_ts, write, out_file):
+    # Records go through a bounded queue to a writer thread, so file I/O and
+    # Parquet encoding never run on the event loop.
+    q = queue.Queue(maxsize=QUEUE_SIZE)
+    writer = asyncio.get_running_loop().run_in_executor(None, write, drain(q), out_file)
+    try:
+        await fetch_all(skeletons, api_keys, obs_ts,
+                        lambda record: enqueue(q, record, writer))
+    finally:
+        await enqueue(q, _DONE, writer)
+    return await writer
+
+def fetch_and_save():
+    skeletons = load_locations(LOCATIONS_CSV)
+    api_keys  = load_api_keys(API_KEYS_CSV)
+    if OUTPUT_FORMAT not in WRITERS:
+        raise ValueError(f"Unknown output format: {OUTPUT_FORMAT!r}")
+    write, ext = WRITERS[OUTPUT_FORMAT]
+    if OUTPUT_FORMAT == 'parquet':
+        # Fail before any API quota is spent if pyarrow is missing.
+        import pyarrow  # noqa: F401
+
+    start = time.time()
+    now = datetime.now()
+    timestamp = now.strftime("%Y%m%d_%H%M")
+    obs_ts = now.isoformat()
+
+    date_dir = now.strftime("%Y%m%d")
     out_dir = os.path.join(OUTPUT_BASE_DIR, date_dir)
     os.makedirs(out_dir, exist_ok=True)
-    out_file = os.path.join(out_dir, f"weather_data_{timestamp}.csv")
+    out_file = os.path.join(out_dir, f"weather_data_{timestamp}.{ext}")
 
-    with open(out_file, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()) if results else [])
-        writer.writeheader()
-        writer.writerows(results)
+    count = asyncio.run(fetch_to_file(skeletons, api_keys, obs_ts, write, out_file))
 
     duration = time.time() - start
-    logging.info("Wrote %d records to %s (%.2fs)", len(results), out_file, duration)
+    logging.info("Wrote %d records to %s (%.2fs)", count, out_file, duration)
 
 if __name__ == "__main__":
     fetch_and_save()
-